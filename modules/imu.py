@@ -0,0 +1,90 @@
+import struct
+import time
+from mpu9250 import MPU9250
+
+_SMPLRT_DIV = 0x19
+_CONFIG = 0x1A
+_INT_ENABLE = 0x38
+_INT_STATUS = 0x3A
+_RAW_RDY = 0x01
+_ACCEL_XOUT_H = 0x3B  # accel, temperature and gyro registers are contiguous
+_HXL = 0x03           # AK8963 HXL..HZH followed by ST2
+
+_TEMP_SO = 333.87
+_TEMP_OFFSET = 21
+
+# One preallocated buffer shared by every register read. Each read is
+# unpacked before the next one is issued, so they can reuse the same memory;
+# the fixed-size views are sliced once here rather than per read.
+_BUF = bytearray(14)
+_MV = memoryview(_BUF)
+_MAG_MV = _MV[:7]
+_STATUS_MV = _MV[:1]
+
+
+class IMU(MPU9250):
+    # MPU9250 driver with a bulk read of every channel the model uses.
+    # Scaling mirrors the driver's own properties (mpu9250.py / ak8963.py).
+
+    def enable_data_ready(self, rate_hz=100):
+        # Sample at rate_hz and raise RAW_RDY in INT_STATUS for every new
+        # sample. The sample rate divider only applies with the DLPF on, so
+        # select DLPF_CFG 3 (41 Hz gyro bandwidth, 1 kHz internal rate).
+        mpu = self.mpu6500
+        mpu.i2c.writeto_mem(mpu.address, _CONFIG, bytes((0x03,)))
+        mpu.i2c.writeto_mem(mpu.address, _SMPLRT_DIV, bytes((1000 // rate_hz - 1,)))
+        mpu.i2c.writeto_mem(mpu.address, _INT_ENABLE, bytes((_RAW_RDY,)))
+
+    def wait_data_ready(self, timeout_ms=100):
+        # Poll INT_STATUS until a new sample is available; reading the
+        # register clears the flag. Polling over I2C works whether or not
+        # the INT pin is connected to a GPIO. Sleep between reads so the
+        # bus and the interpreter are free for other threads.
+        mpu = self.mpu6500
+        start = time.ticks_ms()
+        while True:
+            mpu.i2c.readfrom_mem_into(mpu.address, _INT_STATUS, _STATUS_MV)
+            if _BUF[0] & _RAW_RDY:
+                return
+            if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                raise OSError("IMU data ready timeout")
+            time.sleep_ms(1)
+
+    def read_all(self):
+        # Return (ax, ay, az, gx, gy, gz, temp, mx, my, mz) using one burst
+        # read on the MPU6500 and one on the AK8963, instead of one I2C
+        # transaction per property.
+        mpu = self.mpu6500
+        mpu.i2c.readfrom_mem_into(mpu.address, _ACCEL_XOUT_H, _MV)
+        ax, ay, az, t, gx, gy, gz = struct.unpack_from(">hhhhhhh", _MV)
+
+        so = mpu._accel_so
+        sf = mpu._accel_sf
+        ax = ax / so * sf
+        ay = ay / so * sf
+        az = az / so * sf
+
+        so = mpu._gyro_so
+        sf = mpu._gyro_sf
+        ox, oy, oz = mpu._gyro_offset
+        gx = gx / so * sf - ox
+        gy = gy / so * sf - oy
+        gz = gz / so * sf - oz
+
+        t = ((t - _TEMP_OFFSET) / _TEMP_SO) + 21
+
+        # Reading through ST2 also releases the data registers for the
+        # next measurement, as the driver's magnetic property does.
+        mag = self.ak8963
+        mag.i2c.readfrom_mem_into(mag.address, _HXL, _MAG_MV)
+        mx, my, mz = struct.unpack_from("<hhh", _MV)
+
+        adj = mag._adjustment
+        so = mag._so
+        offset = mag._offset
+        scale = mag._scale
+        mx = (mx * adj[0] * so - offset[0]) * scale[0]
+        my = (my * adj[1] * so - offset[1]) * scale[1]
+        mz = (mz * adj[2] * so - offset[2]) * scale[2]
+
+        return ax, ay, az, gx, gy, gz, t, mx, my, mz
@@ -1,99 +1,190 @@
 import math
+from array import array
+
+try:
+    import micropython
+except ImportError:
+    # Running under CPython (e.g. desktop testing): the MicroPython code
+    # emitters are not available, so the decorators become no-ops.
+    class micropython:
+        @staticmethod
+        def native(f):
+            return f
+
+DEG2RAD = math.pi / 180.0
+RAD2DEG = 180.0 / math.pi
+
+# Largest |q|^2 - 1 renormalized with the Newton step instead of a sqrt
+QNORM_TOL = 1e-3
+
+
+# Source of one IMU-only Madgwick update on plain floats. beta and the
+# gyroscope scale are substituted as literals by make_madgwick_step, so the
+# generated function has no attribute or global loads (sqrt is bound as a
+# default argument, i.e. a local).
+_STEP_SRC = """
+@micropython.native
+def step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, dt, sqrt=sqrt):
+    # Normalize accelerometer measurement
+    norm = ax * ax + ay * ay + az * az
+    if norm == 0:
+        return q0, q1, q2, q3  # avoid division by zero
+    inv = 1.0 / sqrt(norm)
+    ax *= inv
+    ay *= inv
+    az *= inv
+
+    # Auxiliary variables to avoid repeated arithmetic
+    _2q0 = 2.0 * q0
+    _2q1 = 2.0 * q1
+    _2q2 = 2.0 * q2
+    _2q3 = 2.0 * q3
+
+    # Gradient descent algorithm corrective step
+    # (This is a simplified IMU-only version of Madgwick’s algorithm.)
+    f1 = _2q1 * q3 - _2q0 * q2 - ax
+    f2 = _2q0 * q1 + _2q2 * q3 - ay
+    f3 = 1.0 - _2q1 * q1 - _2q2 * q2 - az
+
+    s0 = -_2q2 * f1 + _2q1 * f3
+    s1 = _2q3 * f1 + _2q0 * f3 - 4.0 * q1 * f2
+    s2 = -_2q0 * f1 + _2q3 * f2 - 4.0 * q2 * f3
+    s3 = _2q1 * f1 + _2q2 * f2
+
+    norm_s = s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3
+    if norm_s == 0:
+        return q0, q1, q2, q3
+    inv = 1.0 / sqrt(norm_s)
+    s0 *= inv
+    s1 *= inv
+    s2 *= inv
+    s3 *= inv
+
+    # Compute rate of change of quaternion. The gyroscope is in degrees/s,
+    # so the 0.5 factor and the radians conversion are a single constant.
+    qDot0 = (-q1 * gx - q2 * gy - q3 * gz) * {half_rad} - {beta} * s0
+    qDot1 = (q0 * gx + q2 * gz - q3 * gy) * {half_rad} - {beta} * s1
+    qDot2 = (q0 * gy - q1 * gz + q3 * gx) * {half_rad} - {beta} * s2
+    qDot3 = (q0 * gz + q1 * gy - q2 * gx) * {half_rad} - {beta} * s3
+
+    # Integrate to yield quaternion
+    q0 += qDot0 * dt
+    q1 += qDot1 * dt
+    q2 += qDot2 * dt
+    q3 += qDot3 * dt
+
+    # Normalize quaternion. It only drifts slightly from unit length per
+    # step, so one Newton iteration of 1/sqrt around 1 is accurate enough;
+    # fall back to the exact form for larger deviations.
+    norm_q = q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3
+    if -{tol} < norm_q - 1.0 < {tol}:
+        inv = 1.5 - 0.5 * norm_q
+    else:
+        inv = 1.0 / sqrt(norm_q)
+    return q0 * inv, q1 * inv, q2 * inv, q3 * inv
+"""
+
+# Generated step functions, keyed by beta
+_steps = {}
+
+
+def make_madgwick_step(beta):
+    # Return step(q0, q1, q2, q3, gx, gy, gz, ax, ay, az, dt) -> (q0, q1, q2, q3)
+    # specialised for a fixed beta (gyroscope in degrees/s).
+    step = _steps.get(beta)
+    if step is None:
+        src = _STEP_SRC.format(beta=float(beta), half_rad=0.5 * DEG2RAD, tol=QNORM_TOL)
+        ns = {'sqrt': math.sqrt, 'micropython': micropython}
+        exec(src, ns)
+        step = _steps[beta] = ns['step']
+    return step
+
+
+def _euler_gravity(q0, q1, q2, q3, atan2=math.atan2, asin=math.asin):
+    # Euler angles (roll, pitch, yaw) in degrees and the gravity vector for
+    # one quaternion, sharing the products both conversions need. The
+    # gravity vector is the last row of the rotation matrix, i.e. the
+    # world z axis seen in the sensor frame.
+    q00 = q0 * q0
+    q11 = q1 * q1
+    q22 = q2 * q2
+    q33 = q3 * q3
+    q01 = q0 * q1
+    q02 = q0 * q2
+    q03 = q0 * q3
+    q12 = q1 * q2
+    q13 = q1 * q3
+    q23 = q2 * q3
+
+    roll = atan2(2.0 * (q01 + q23), 1.0 - 2.0 * (q11 + q22)) * RAD2DEG
+
+    # Clamp instead of branching; asin(+-1) is exactly +-90 degrees
+    sinp = 2.0 * (q02 - q13)
+    sinp = -1.0 if sinp < -1.0 else (1.0 if sinp > 1.0 else sinp)
+    pitch = asin(sinp) * RAD2DEG
+
+    yaw = atan2(2.0 * (q03 + q12), 1.0 - 2.0 * (q22 + q33)) * RAD2DEG
+
+    return (roll, pitch, yaw, 2.0 * (q13 - q02), 2.0 * (q01 + q23), q00 - q11 - q22 + q33)
+
 
 class Madgwick:
     def __init__(self, beta=0.1, q0=1.0, q1=0.0, q2=0.0, q3=0.0):
         self.beta = beta
-        self.q0 = q0
-        self.q1 = q1
-        self.q2 = q2
-        self.q3 = q3
+        self._step = make_madgwick_step(beta)
+        # Quaternion state stored as float32, well above the sensor's precision
+        self.q = array('f', (q0, q1, q2, q3))
 
     def updateIMU(self, gx, gy, gz, ax, ay, az, dt):
-        # Convert gyroscope degrees/s to radians/s
-        gx = math.radians(gx)
-        gy = math.radians(gy)
-        gz = math.radians(gz)
-
-        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
-
-        # Normalize accelerometer measurement
-        norm = math.sqrt(ax * ax + ay * ay + az * az)
-        if norm == 0:
-            return  # avoid division by zero
-        ax /= norm
-        ay /= norm
-        az /= norm
-
-        # Auxiliary variables to avoid repeated arithmetic
-        _2q0 = 2.0 * q0
-        _2q1 = 2.0 * q1
-        _2q2 = 2.0 * q2
-        _2q3 = 2.0 * q3
-
-        # Gradient descent algorithm corrective step
-        # (This is a simplified IMU-only version of Madgwick’s algorithm.)
-        f1 = _2q1 * q3 - _2q0 * q2 - ax
-        f2 = _2q0 * q1 + _2q2 * q3 - ay
-        f3 = 1.0 - _2q1 * q1 - _2q2 * q2 - az
-
-        s0 = -_2q2 * f1 + _2q1 * f3
-        s1 = _2q3 * f1 + _2q0 * f3 - 4.0 * q1 * f2
-        s2 = -_2q0 * f1 + _2q3 * f2 - 4.0 * q2 * f3
-        s3 = _2q1 * f1 + _2q2 * f2
-
-        norm_s = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
-        if norm_s == 0:
-            return
-        s0 /= norm_s
-        s1 /= norm_s
-        s2 /= norm_s
-        s3 /= norm_s
-
-        # Compute rate of change of quaternion
-        qDot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz) - self.beta * s0
-        qDot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy) - self.beta * s1
-        qDot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx) - self.beta * s2
-        qDot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx) - self.beta * s3
-
-        # Integrate to yield quaternion
-        q0 += qDot0 * dt
-        q1 += qDot1 * dt
-        q2 += qDot2 * dt
-        q3 += qDot3 * dt
-
-        # Normalize quaternion
-        norm_q = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
-        q0 /= norm_q
-        q1 /= norm_q
-        q2 /= norm_q
-        q3 /= norm_q
-
-        self.q0, self.q1, self.q2, self.q3 = q0, q1, q2, q3
-
-    def getEuler(self):
-        # Convert current quaternion to Euler angles (roll, pitch, yaw)
-        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
-        sinr_cosp = 2.0 * (q0 * q1 + q2 * q3)
-        cosr_cosp = 1.0 - 2.0 * (q1 * q1 + q2 * q2)
-        roll = math.degrees(math.atan2(sinr_cosp, cosr_cosp))
-
-        sinp = 2.0 * (q0 * q2 - q3 * q1)
-        if abs(sinp) >= 1:
-            pitch = math.degrees(math.copysign(math.pi / 2, sinp))
-        else:
-            pitch = math.degrees(math.asin(sinp))
-
-        siny_cosp = 2.0 * (q0 * q3 + q1 * q2)
-        cosy_cosp = 1.0 - 2.0 * (q2 * q2 + q3 * q3)
-        yaw = math.degrees(math.atan2(siny_cosp, cosy_cosp))
-        return [roll, pitch, yaw]
-
-    def getGravity(self):
+        q = self.q
+        q[0], q[1], q[2], q[3] = self._step(
+            q[0], q[1], q[2], q[3], gx, gy, gz, ax, ay, az, dt)
+
+    def updateIMU_batch(self, gyro, acc, dt):
+        # Run the filter over a whole window of samples in one call.
+        # gyro and acc are sequences of (x, y, z) readings, dt the matching
+        # time steps. The quaternion state is inherently sequential, so the
+        # samples are still processed in order; the state after each step is
+        # returned so the caller can derive per-sample features afterwards.
+        # Each step goes through the float32 state, as in updateIMU, so both
+        # paths produce identical quaternions.
+        states = []
+        append = states.append
+        step = self._step
+        q = self.q
+        for i in range(len(dt)):
+            g = gyro[i]
+            a = acc[i]
+            q[0], q[1], q[2], q[3] = step(q[0], q[1], q[2], q[3], g[0], g[1], g[2], a[0], a[1], a[2], dt[i])
+            append((q[0], q[1], q[2], q[3]))
+        return states
+
+    def getEuler(self, q=None):
+        # Convert a quaternion (current state by default) to Euler angles (roll, pitch, yaw)
+        q0, q1, q2, q3 = q if q is not None else self.q
+        return _euler_gravity(q0, q1, q2, q3)[:3]
+
+    def getGravity(self, q=None):
         # Compute the gravity vector in the sensor frame from the quaternion
-        q0, q1, q2, q3 = self.q0, self.q1, self.q2, self.q3
+        q0, q1, q2, q3 = q if q is not None else self.q
         # In a perfect system, if global gravity is [0, 0, g] (with g normalized to 1),
         # then the gravity vector in sensor frame becomes:
         g_x = 2.0 * (q1 * q3 - q0 * q2)
         g_y = 2.0 * (q0 * q1 + q2 * q3)
         g_z = q0 * q0 - q1 * q1 - q2 * q2 + q3 * q3
-        return [g_x, g_y, g_z]
+        return (g_x, g_y, g_z)
+
+    def getEulerAndGravity(self, q=None):
+        # Euler angles (roll, pitch, yaw) and gravity vector in one pass
+        q0, q1, q2, q3 = q if q is not None else self.q
+        return _euler_gravity(q0, q1, q2, q3)
+
+    def getEulerAndGravity_batch(self, states):
+        # getEulerAndGravity for every quaternion in states (e.g. the list
+        # returned by updateIMU_batch)
+        convert = _euler_gravity
+        out = []
+        append = out.append
+        for q0, q1, q2, q3 in states:
+            append(convert(q0, q1, q2, q3))
+        return out
@@ -4,6 +4,8 @@ import ujson
 import utime, time
 from machine import I2C, Pin
 import gc
+import _thread
+import select
 
 wifi_ssid = 'OnePlus 10R 5G'
 wifi_password = '34567890'
@@ -122,9 +124,22 @@ h1 {
 }
 """
 
+def http_response(content_type, body):
+    # Build a complete response (headers + body) as bytes, with Content-Length
+    body = body.encode()
+    header = "HTTP/1.1 200 OK\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(content_type, len(body))
+    return header.encode() + body
+
+# Static pages are encoded once at import instead of on every request
+HTML_RESP = http_response('text/html', html_template)
+CSS_RESP = http_response('text/css', css_styles)
+
 # Global state variable
 device_state = False
 
+# Free heap (bytes) below which the server runs a garbage collection
+GC_THRESHOLD = 20000
+
 # Wi-Fi connection
 def connect_wifi():
     wlan = network.WLAN(network.STA_IF)
@@ -161,14 +176,19 @@ try:
         try:
             from mpu9250 import MPU9250
             from ak8963 import AK8963
+            from imu import IMU
             import motion_model, steady_model, unsteady_model, staircase_model, surface_model
             from madgwick import Madgwick
             import display
             
             dummy = MPU9250(i2c)
             ak8963 = AK8963(i2c)
-            sensor = MPU9250(i2c, ak8963=ak8963)
+            sensor = IMU(i2c, ak8963=ak8963)
+            sensor.enable_data_ready(100)
             print("MPU9250 id:", hex(sensor.whoami))
+            # Single filter instance so the orientation estimate carries
+            # over between predictions instead of restarting from identity
+            madgwick = Madgwick(beta=0.1)
             sensors_initialized = True
         except Exception as e:
             print("Sensor initialization error:", e)
@@ -201,11 +221,32 @@ mapper = {
 prediction_buffer = []
 buffer_size = 3  # Store last 3 predictions for smoothing
 
-def get_prediction():
-    global device_state, last_button_state, last_time, prediction_buffer
-    
-    if not sensors_initialized:
-        return "Sensor Error"
+# Sample window buffers, allocated once and refilled by every prediction
+samples_to_collect = 30
+gyro_window = [[0.0] * 3 for _ in range(samples_to_collect)]
+acc_window = [[0.0] * 3 for _ in range(samples_to_collect)]
+dt_window = [0.0] * samples_to_collect
+# Longest time step (s) fed to the filter. Gaps between windows or after an
+# error are clamped so one stale dt cannot swing the persistent quaternion.
+MAX_DT = 0.05
+# Per-sample model input: euler(3), gravity(3), gyro(3), accel(3), mag(3), temperature
+feature_window = [[0.0] * 16 for _ in range(samples_to_collect)]
+# Votes per activity class for the current window
+category = [0] * 7
+
+# Text currently on the display. The sampler calls get_prediction in a
+# tight loop, so the screen is only redrawn when the text changes.
+shown_text = None
+
+def show(text):
+    global shown_text
+    if text != shown_text:
+        display.screen(text).show_once()
+        shown_text = text
+
+def check_device():
+    # Handle the ON/OFF button; returns True while the device is ON
+    global device_state, last_button_state, last_time
     
     # Check button state
     current_button_state = pin.value()
@@ -216,66 +257,101 @@ def get_prediction():
         if pin.value() == 0:
             device_state = not device_state
             if not device_state:
-                display.screen("Device OFF").show_once()
+                show("Device OFF")
             else:
-                display.screen("Device ON").show_once()
+                show("Device ON")
     
     last_button_state = current_button_state
 
     if not device_state:
-        display.screen("System is OFF").show_once()
+        show("System is OFF")
+        # Restart the sample clock so the first step after switching on
+        # does not integrate the whole time spent OFF
+        last_time = time.ticks_ms()
+        return False
+    return True
+
+def read_sample(c):
+    # Wait for the next IMU sample and store it in slot c of the window
+    # buffers; features 0..5 are filled in by classify_window
+    global last_time
+    
+    # Pace the window by the sensor's own output rate
+    sensor.wait_data_ready()
+    ax, ay, az, gx, gy, gz, t, mx, my, mz = sensor.read_all()
+    current_time = time.ticks_ms()
+    dt = time.ticks_diff(current_time, last_time) / 1000.0
+    dt_window[c] = dt if dt < MAX_DT else MAX_DT
+    last_time = current_time
+    
+    g = gyro_window[c]
+    g[0], g[1], g[2] = gx, gy, gz
+    a = acc_window[c]
+    a[0], a[1], a[2] = ax, ay, az
+    X = feature_window[c]
+    X[6], X[7], X[8] = gx, gy, gz
+    X[9], X[10], X[11] = ax, ay, az
+    X[12], X[13], X[14] = mx, my, mz
+    X[15] = t
+
+def get_prediction():
+    if not sensors_initialized:
+        return "Sensor Error"
+    
+    if not check_device():
         utime.sleep_ms(100) 
         return "Device OFF"
     
-    category = [0] * 7
-    c = 0
-    samples_to_collect = 30 
-    
-    while c < samples_to_collect:
+    # Collect the whole window of IMU readings first, straight into the
+    # preallocated buffers
+    for c in range(samples_to_collect):
         try:
-            X = list(sensor.gyro) + list(sensor.acceleration) + list(sensor.magnetic) + [sensor.temperature]
-            madgwick = Madgwick(beta=0.1)
-            current_time = time.ticks_ms()
-            dt = time.ticks_diff(current_time, last_time) / 1000.0
-            last_time = current_time
-            madgwick.updateIMU(X[0], X[1], X[2], X[3], X[4], X[5], dt)
-            X = madgwick.getEuler() + madgwick.getGravity() + X
-            
-            # Model scoring logic
-            motion_score = motion_model.score(X)
-            if motion_score[0] >= motion_score[1]:
-                steady_score = steady_model.score(X)
-                score = [0, 0, 0, 0, steady_score[0], steady_score[1], steady_score[2]]
-            else:
-                unsteady_score = unsteady_model.score(X)
-                if unsteady_score[0] <= unsteady_score[1]:
-                    staircase_score = staircase_model.score(X)
-                    score = [0, 0, staircase_score[0], staircase_score[1], 0, 0, 0]
-                else:
-                    surface_score = surface_model.score(X)
-                    score = [surface_score[0], surface_score[1], 0, 0, 0, 0, 0]
-            
-            # Find highest score
-            maxval = max(score)
-            for i, s in enumerate(score):
-                if s == maxval:
-                    category[i] += 1
-                    
-            utime.sleep_ms(50)  # Reduced sleep time
-            c += 1
-            
+            read_sample(c)
         except Exception as e:
             print("Prediction error:", e)
             return "Sensor Error"
     
-    # Determine most frequent category
-    maxcat = max(category)
-    index = 0
-    for i, c in enumerate(category):
-        if c == maxcat:
-            index = i
-            break
+    return classify_window()
+
+def classify_window():
+    # Filter and score a full window; returns the detected activity
+    global prediction_buffer
+    
+    # Run the orientation filter over the window in one call
+    states = madgwick.updateIMU_batch(gyro_window, acc_window, dt_window)
+    orientation = madgwick.getEulerAndGravity_batch(states)
+    
+    # Bind the model entry points once for the whole window
+    motion_score = motion_model.score
+    steady_score = steady_model.score
+    unsteady_score = unsteady_model.score
+    staircase_score = staircase_model.score
+    surface_score = surface_model.score
+    
+    for i in range(7):
+        category[i] = 0
+    
+    for i in range(samples_to_collect):
+        X = feature_window[i]
+        X[0:6] = orientation[i]
         
+        # Walk the model cascade; the selected leaf votes for its own
+        # argmax, with ties going to the lower class index
+        score = motion_score(X)
+        if score[0] >= score[1]:
+            score = steady_score(X)
+            category[4 + score.index(max(score))] += 1
+        else:
+            score = unsteady_score(X)
+            if score[0] <= score[1]:
+                score = staircase_score(X)
+                category[2 if score[0] >= score[1] else 3] += 1
+            else:
+                score = surface_score(X)
+                category[0 if score[0] >= score[1] else 1] += 1
+    
+    # Determine most frequent category
+    index = category.index(max(category))
     
     activity = mapper.get(index , 'Unknown')
     
@@ -303,12 +379,68 @@ def get_prediction():
         
         #activity = smoothed_activity
     
-    print("Detected activity:", activity)
+    if activity != shown_text:
+        print("Detected activity:", activity)
     
     # Display the result
-    display.screen(activity).show_once()
+    show(activity)
     return activity
 
+# Most recent classification, published by the sampler. Rebinding a
+# global string is atomic, so the HTTP handler can read it without a lock.
+latest_activity = "Unknown"
+sampler_running = False
+
+# Poll timeout (ms) between sampler steps when no sampler thread is available
+POLL_MS = 10
+
+# Stack size (bytes) for the sampler thread
+SAMPLER_STACK = 16 * 1024
+
+def update_activity():
+    # Run one prediction and publish the result
+    global latest_activity
+    try:
+        latest_activity = get_prediction()
+    except Exception as e:
+        print("Sampler error:", e)
+        latest_activity = "Sensor Error"
+
+# Next window slot filled by sampler_step
+window_pos = 0
+
+def sampler_step():
+    # One short piece of sampling work for the server's poll loop, used
+    # when there is no sampler thread: a single sample read, or, once the
+    # window is full, classifying it. A waiting connection is delayed by at
+    # most one step: one sample period (~10 ms), one window classification,
+    # or the 500 ms button debounce.
+    global window_pos, latest_activity
+    if not sensors_initialized:
+        latest_activity = "Sensor Error"
+        return
+    try:
+        if window_pos == 0 and not check_device():
+            latest_activity = "Device OFF"
+            return
+        read_sample(window_pos)
+        window_pos += 1
+        if window_pos == samples_to_collect:
+            window_pos = 0
+            latest_activity = classify_window()
+    except Exception as e:
+        print("Sampler error:", e)
+        window_pos = 0
+        latest_activity = "Sensor Error"
+
+def sampler():
+    # Background thread that keeps latest_activity current, so /activity
+    # is answered from the last result instead of sampling per request.
+    # On the ESP32 port threads share one core and the GIL with the server;
+    # the sampler mostly waits on I2C, which leaves the server room to run.
+    while True:
+        update_activity()
+
 def start_server():
     try:
         addr = socket.getaddrinfo('0.0.0.0', 80)[0][-1]
@@ -317,24 +449,35 @@ def start_server():
         s.listen(1)
         print('Listening on', addr)
 
+        poller = select.poll()
+        poller.register(s, select.POLLIN)
+
         while True:
+            # With the sampler thread running, just wait for a connection.
+            # Otherwise wake every POLL_MS and advance sampling by one step,
+            # so neither the socket nor the sampler is starved.
+            events = poller.poll(-1 if sampler_running else POLL_MS)
+            if not sampler_running:
+                sampler_step()
+            if not events:
+                continue
+
             try:
                 cl, addr = s.accept()
-                request = cl.recv(1024).decode('utf-8')
-                request_line = request.split('\r\n')[0]
+                # Only the request line is needed; keep it as bytes
+                request = cl.recv(512)
+                end = request.find(b'\r\n')
+                request_line = request[:end] if end >= 0 else request
                 print("Request:", request_line)
 
-                if 'GET / ' in request_line or 'GET /index.html' in request_line:
-                    cl.send('HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n')
-                    cl.sendall(html_template)
+                if request_line.startswith(b'GET / ') or request_line.startswith(b'GET /index.html'):
+                    cl.sendall(HTML_RESP)
 
-                elif 'GET /style.css' in request_line:
-                    cl.send('HTTP/1.1 200 OK\r\nContent-Type: text/css\r\n\r\n')
-                    cl.sendall(css_styles)
+                elif request_line.startswith(b'GET /style.css'):
+                    cl.sendall(CSS_RESP)
 
-                elif 'GET /activity' in request_line:
-                    activity = get_prediction()
-                    result = {'status': 'success', 'activity': activity}
+                elif request_line.startswith(b'GET /activity'):
+                    result = {'status': 'success', 'activity': latest_activity}
                     response = ujson.dumps(result)
                     cl.send('HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n')
                     cl.send(response)
@@ -346,15 +489,29 @@ def start_server():
                 print("Client handling error:", e)
             finally:
                 cl.close()
-                # Run garbage collection to free memory
-                gc.collect()
+                # Only collect when the heap runs low; a full collection on
+                # every request stalls the server for nothing
+                if gc.mem_free() < GC_THRESHOLD:
+                    gc.collect()
     
     except Exception as e:
         print("Server error:", e)
 
 # Main execution
 def main():
+    global latest_activity, sampler_running
     if connect_wifi():
+        if sensors_initialized:
+            try:
+                # The default thread stack (~5 KB on ESP32) is too small for
+                # the generated model cascade
+                _thread.stack_size(SAMPLER_STACK)
+                _thread.start_new_thread(sampler, ())
+                sampler_running = True
+            except Exception as e:
+                print("Sampler thread error:", e)
+        else:
+            latest_activity = "Sensor Error"
         start_server()
     else:
         print("Failed to connect to WiFi, cannot start server.")